@@ -1,14 +1,18 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.services.document_service import DocumentService
 from app.models.query_models import QueryRequest, QueryResponse
 from dotenv import load_dotenv
+import asyncio
 import os
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Document Query System")
+# Serialize responses with orjson (SIMD JSON encoder) instead of the
+# pure-Python default, which matters for long answer paragraphs
+app = FastAPI(title="Document Query System", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -21,6 +25,16 @@ app.add_middleware(
 
 document_service = DocumentService()
 
+@app.on_event("startup")
+async def startup_event():
+    # Warm up the Gemini connection and HTTP session in the background so
+    # the first real request doesn't pay the cold-start cost
+    asyncio.create_task(document_service.warmup())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await document_service.close()
+
 @app.post("/hackrx/run", response_model=QueryResponse)
 async def process_query(request: QueryRequest):
     try: